@@ -1,7 +1,16 @@
 
+import json
 import cherrypy
 from mamabear.model import *
 
+def _flag(value):
+    """
+    Query string booleans arrive as strings
+    """
+    if isinstance(value, bool):
+        return value
+    return value.lower() in ('true', '1', 'yes')
+
 class HostController(object):
 
     #
@@ -247,6 +256,26 @@ class ContainerController(object):
             
         cherrypy.response.status = 404
         return {'error': 'container with id: {} not found'.format(container_id)}
+
+    def stream_container_logs(self, container_id, stderr=True, stdout=False, limit=100):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        try:
+            limit = int(limit)
+        except ValueError:
+            cherrypy.response.status = 400
+            return json.dumps({'error': 'limit must be an integer'})
+
+        container = Container.get(cherrypy.request.db, container_id)
+        if container:
+            logs = self.worker.get_container_logs_stream(
+                container, self.worker._config, stderr=_flag(stderr),
+                stdout=_flag(stdout), limit=limit)
+            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            return logs
+
+        cherrypy.response.status = 404
+        return json.dumps({'error': 'container with id: {} not found'.format(container_id)})
+    stream_container_logs._cp_config = {'response.stream': True}
         
     @cherrypy.tools.json_out()
     def get_container(self, container_id):
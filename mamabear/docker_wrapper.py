@@ -7,6 +7,10 @@ logging.basicConfig(level=logging.INFO)
 
 class DockerWrapper(object):
 
+    # TLS configs keyed by (client_cert, client_key), so cert files
+    # are only loaded once per process
+    _tls_configs = {}
+
     def __init__(self, docker_host, docker_port, config, retry=3):
         self.host = docker_host
         self.port = docker_port
@@ -14,19 +18,27 @@ class DockerWrapper(object):
         self.registry_user = config.get('registry', 'user')
         self.registry_pass = config.get('registry', 'password')
         
-        self._tls_conf = docker.tls.TLSConfig(
-            assert_hostname=False,
-            verify=False,
-            client_cert=(
-                config.get('docker', 'client_cert'),
-                config.get('docker', 'client_key')
-            ))
+        self._tls_conf = DockerWrapper._tls_config(
+            config.get('docker', 'client_cert'),
+            config.get('docker', 'client_key'))
         self._client = docker.Client(
             base_url='https://%s:%s' % (docker_host, docker_port),
             timeout=10, # 10 second timeout
             tls=self._tls_conf
         )
 
+    @staticmethod
+    def _tls_config(client_cert, client_key):
+        key = (client_cert, client_key)
+        tls_conf = DockerWrapper._tls_configs.get(key)
+        if tls_conf is None:
+            tls_conf = docker.tls.TLSConfig(
+                assert_hostname=False,
+                verify=False,
+                client_cert=key)
+            DockerWrapper._tls_configs[key] = tls_conf
+        return tls_conf
+
     @staticmethod
     def list_images(registry_url, app_name, username, password=None):
         url = "%s/repositories/%s/%s/tags" % (registry_url, username, app_name)
@@ -96,9 +108,12 @@ class DockerWrapper(object):
     def inspect(self, container_id):
         return self._client_request('inspect_container', container_id)
         
-    def logs(self, container_id, stderr=False, stdout=False, stream=False, tail=10):
-        return self._client_request('logs', container_id, stderr=stderr,
-                                    stdout=stdout, stream=stream, tail=tail)
+    def logs(self, container_id, stderr=False, stdout=False, stream=False, tail=10, follow=False):
+        kwargs = {'stderr': stderr, 'stdout': stdout, 'stream': stream, 'tail': tail}
+        if stream:
+            # docker-py follows streamed logs unless told not to
+            kwargs['follow'] = follow
+        return self._client_request('logs', container_id, **kwargs)
 
     def pull(self, **kwargs):
         return self._client_request('pull', **kwargs)
@@ -157,18 +172,15 @@ class DockerWrapper(object):
         linked_apps = d.get('links')
         linked_volumes = d.get('volumes')
         
-        ports = []
-        port_bindings = {}
-        if mapped_ports:
-            port_bindings = dict([[int(p) for p in pm.split(':')] for pm in mapped_ports if pm and len(pm.split(':')) == 2])
-            ports = port_bindings.keys()
-
-        volumes = []
-        volume_bindings = {}
-        if mapped_volumes:
-            mv = dict([vm.strip().split(':') for vm in mapped_volumes if vm and len(vm.split(':')) == 2])
-            volume_bindings = dict([(container_volume, {'bind':mv[container_volume]}) for container_volume in mv])
-            volumes = mv.values()
+        # Each mapping is split once; malformed entries are skipped
+        port_pairs = (pm.split(':') for pm in mapped_ports or () if pm)
+        port_bindings = {int(p[0]): int(p[1]) for p in port_pairs if len(p) == 2}
+        ports = list(port_bindings)
+
+        volume_pairs = (vm.strip().split(':') for vm in mapped_volumes or () if vm)
+        mv = dict(v for v in volume_pairs if len(v) == 2)
+        volume_bindings = {k: {'bind': v} for k, v in mv.items()}
+        volumes = list(mv.values())
 
         volumes_from = []
         if linked_volumes:
@@ -176,7 +188,7 @@ class DockerWrapper(object):
 
         links = {}
         if linked_apps:
-            links = dict([(la['app_name'], la['app_name']) for la in linked_apps])
+            links = {la['app_name']: la['app_name'] for la in linked_apps}
 
         c = None
         container = None
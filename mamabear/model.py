@@ -486,7 +486,7 @@ class Deployment(Base):
 
     def encode_with_deps(self, session):
         result = {'deployment': self.encode(), 'dependencies':[]}
-        children = dict([(image.id, image) for image in self.links+self.volumes])
+        children = {image.id: image for image in self.links+self.volumes}
         for child_id in children:
             child = children[child_id]
             child_deployment = Deployment.get_by_app(
@@ -512,7 +512,7 @@ class Deployment(Base):
             'links': [image.encode() for image in self.links],
             'volumes': [image.encode() for image in self.volumes],
             'containers': [c.encode() for c in self.containers],
-            'environment_variables': dict([(p.property_key, p.property_value) for p in self.env_vars])
+            'environment_variables': {p.property_key: p.property_value for p in self.env_vars}
         }
 
 class EnvironmentVariable(Base):
@@ -43,6 +43,7 @@ def get_app():
         m.connect('containers', '/container', action='list_containers', conditions=dict(method=['GET']))
         m.connect('container_get', '/container/{container_id}', action='get_container', conditions=dict(method=['GET']))
         m.connect('container_get_logs', '/container/{container_id}/logs', action='get_container_logs', conditions=dict(method=['GET']))
+        m.connect('container_stream_logs', '/container/{container_id}/logs/stream', action='stream_container_logs', conditions=dict(method=['GET']))
 
     with d.mapper.submapper(path_prefix='/mamabear/v1', controller='mamabear-deployments') as m:
         m.connect('deployments_all', '/deployment', action='list_deployments', conditions=dict(method=['GET']))
@@ -111,9 +112,14 @@ def start(config):
     cherrypy.engine.block()
     cherrypy.quickstart(app)
 
+# Kept between runs so the worker's connection pools are reused
+_update_worker = None
+
 def update_all_job(config):
-    worker = Worker(config)
-    worker.update_all()
+    global _update_worker
+    if _update_worker is None:
+        _update_worker = Worker(config)
+    _update_worker.update_all()
     
 def start_worker(config):
     connection_string = "mysql://%s:%s@%s/%s" % (
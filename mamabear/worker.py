@@ -1,18 +1,46 @@
-import time
+import atexit
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import tz
 from dateutil import parser
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict
 from mamabear.model import *
 from mamabear.docker_wrapper import DockerWrapper
 from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 logging.basicConfig(level=logging.INFO)
 
+_LOCAL_TZ = tz.tzlocal()
+_UTC = tz.tzutc()
+
+def _parse_docker_ts(s):
+    """
+    Convert a docker timestamp (RFC 3339 in UTC, eg.
+    2015-06-10T19:58:31.803716783Z) to a naive local datetime.
+    Anything else falls back to dateutil.
+    """
+    if s.endswith('Z'):
+        seconds, _, fraction = s[:-1].partition('.')
+        try:
+            ts = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+            microsecond = int((fraction + '000000')[:6])
+        except ValueError:
+            pass
+        else:
+            ts = ts.replace(microsecond=microsecond, tzinfo=_UTC)
+            return ts.astimezone(_LOCAL_TZ).replace(tzinfo=None)
+    return parser.parse(s).astimezone(_LOCAL_TZ).replace(tzinfo=None)
+
 class Worker(object):
     """
     Class that makes use of the docker wrapper to
@@ -25,25 +53,53 @@ class Worker(object):
             config.get('mysql', 'passwd'),
             config.get('mysql', 'host'),
             config.get('mysql', 'database')
-        ), echo=False)    
-
-    def get_session(self, engine):    
-        sess = scoped_session(sessionmaker(autoflush=True,
-                                       autocommit=False))
-        sess.configure(bind=engine)
-        return sess
+        ), echo=False, pool_size=20, max_overflow=40,
+           pool_pre_ping=True, pool_recycle=1800)
 
     def __init__(self, config, updateOnStart=False):        
         self._config = config
+        # One engine (and connection pool) for the life of the worker,
+        # with sessions handed out per thread
+        self._engine = self.get_engine(config)
+        self._Session = scoped_session(sessionmaker(bind=self._engine,
+                                                    autoflush=True,
+                                                    autocommit=False,
+                                                    expire_on_commit=False))
         # Just one registry is allowed for now, and is configured at
         # server launch time
         self._registry_url = config.get('registry', 'host')
         # Registry user is *required*
         self._registry_user = config.get('registry', 'user')
         self._registry_password = config.get('registry', 'password')
+        # Status probes share one pooled session so connections are
+        # reused between containers and refresh cycles
+        self._http = requests.Session()
+        self._http.mount('http://', HTTPAdapter(
+            pool_connections=32, pool_maxsize=64,
+            max_retries=Retry(total=3, backoff_factor=1)))
+        # Raw and parsed finished_at last written per container id
+        self._last_seen = {}
+        # Docker clients are cached per (hostname, port)
+        self._wrappers = {}
+        self._wrappers_lock = threading.Lock()
+        # Deployments run in the background on a bounded pool
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='deploy')
+        atexit.register(self._executor.shutdown)
         if updateOnStart:            
             self.update_all()
         
+    def _wrapper_for(self, hostname, port):
+        """
+        Return the cached docker wrapper for a host, creating it on
+        first use so tls setup and the connection pool are shared
+        """
+        with self._wrappers_lock:
+            wrapper = self._wrappers.get((hostname, port))
+            if wrapper is None:
+                wrapper = DockerWrapper(hostname, port, self._config)
+                self._wrappers[(hostname, port)] = wrapper
+            return wrapper
+
     def image_ref(self, app_name, image_tag):
         return "%s/%s:%s" % (self._registry_user, app_name, image_tag)
 
@@ -60,6 +116,14 @@ class Worker(object):
         logging.info("Fetching images for {} from {} ...".format(app.name, self._registry_url))
         images = DockerWrapper.list_images(
             self._registry_url, app.name, self._registry_user, self._registry_password)
+
+        # Fetch containers for every image in one query, keyed by image ref
+        refs = [self.image_ref(app.name, image_info['name']) for image_info in images]
+        containers_by_ref = defaultdict(list)
+        if refs:
+            for container in db.query(Container).filter(Container.image_ref.in_(refs)).all():
+                containers_by_ref[container.image_ref].append(container)
+
         for image_info in images:
             image = Image.get(db, image_info['layer'])
             if image:
@@ -69,7 +133,7 @@ class Worker(object):
                 logging.info("Found new image {}, setting tag to {}".format(image_info['layer'], image_info['name']))
                 image = Image(id=image_info['layer'], tag=image_info['name'])
 
-            for container in self.containers_for_app_image(db, app.name, image.tag):
+            for container in containers_by_ref[self.image_ref(app.name, image.tag)]:
                 logging.info("Found container {} with state: [{}], associated with image: {}, linking".format(
                     container.id, container.state, image.id
                 ))
@@ -77,17 +141,22 @@ class Worker(object):
             
             app.images.append(image)
             db.add(image)
-            db.add(app)
-        db.commit()
+        db.add(app)
+        db.flush()
 
     def update_deployment_containers(self, db, deployment, config):
         """
         Update container state for all containers on the deployment's configured hosts.
+        Docker state is fetched for every host before anything is written, so
+        callers should commit pending work first.
         """
-        for host in deployment.hosts:
+        for host, host_container_info in self._fetch_hosts_state(deployment.hosts):
             logging.info("Updating containers for host: {}".format(host.hostname))
-            self.update_host_containers(db, host, config)
+            self._apply_host_state(db, host, host_container_info)
 
+        # The bulk delete in _apply_host_state doesn't touch loaded
+        # collections, so reload containers rather than keep removed ones
+        db.expire(deployment, ['containers'])
         for container in self.containers_for_app_image(db, deployment.app_name, deployment.image_tag):
             logging.info("Found container {} with state: [{}], associated with deployment: {}, linking".format(
                 container.id, container.state, deployment.name()
@@ -95,127 +164,251 @@ class Worker(object):
             deployment.containers.append(container)
         
         db.add(deployment)
-        db.commit()
+        db.flush()
 
-    def _check_app_status(self, url, timeout=10, retry=3):
-        last_exception = None
-        for attempt in range(1, retry+1):
-            try:
-                r = requests.get(url, timeout=timeout)
-                if r.ok:
-                    return 'up'
-                else:
-                    return 'down'
-            except Exception as e:
-                logging.warn("Failed to check status of: {}, reason: [{}]".format(url, e.message))
-                time.sleep(5)
-                last_exception = e
+    def _check_app_status(self, url, timeout=10):
+        """
+        Probe a status url over the worker's pooled http session.
+        Connection failures are retried by the adapter; the last one
+        is raised once retries run out.
+        """
+        r = self._http.get(url, timeout=timeout)
+        if r.ok:
+            return 'up'
         else:
-            raise last_exception
+            return 'down'
 
     def update_deployment(self, db, deployment):
+        """
+        Refresh a deployment's containers, then their app status. The
+        container writes are committed before probing so no row locks
+        are held across the status calls; the caller commits the rest.
+        """
         self.update_deployment_containers(db, deployment, self._config)
+        db.commit()
         self.update_deployment_status(db, deployment)
                         
+    def _probe_status(self, container_id, status_url):
+        logging.info("Checking status of {} for container: {}".format(status_url, container_id))
+        try:
+            status = self._check_app_status(status_url)
+            logging.info("Got status of {} for container: {}".format(status, container_id))
+            return container_id, status
+        except Exception as e:
+            logging.warn("Failed to check status, {}".format(e))
+            return container_id, 'down'
+
     def update_deployment_status(self, db, deployment):
         """
         Update app status for all of the deployment's containers
         """
+        probes = []
         for container in deployment.containers:
             if container.state == 'running':
                 status_url = "http://%s:%s/%s" % (
                     container.host.hostname,
                     deployment.status_port,
                     deployment.status_endpoint)
-                
-                logging.info("Checking status of {} for container: {}".format(status_url, container.id))
-                try:
-                    status = self._check_app_status(status_url)
-                    logging.info("Got status of {} for container: {}".format(status, container.id))
-                    container.status = status
-                except Exception as e:
-                    logging.warn("Failed to check status, {}".format(e.message))
-                    container.status = 'down'                
-            else:
-                container.status = 'down'                
-            db.add(container)
-        db.commit()
+                probes.append((container.id, status_url))
+
+        # Probes are network bound, run them concurrently over the
+        # shared http pool and only touch the session on this thread
+        statuses = {}
+        if probes:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                statuses = dict(executor.map(lambda p: self._probe_status(*p), probes))
+
+        # One UPDATE per status value rather than one per container
+        buckets = defaultdict(list)
+        for container in deployment.containers:
+            status = statuses.get(container.id, 'down')
+            if container.status != status:
+                buckets[status].append(container)
+
+        for status, containers in buckets.items():
+            ids = [container.id for container in containers]
+            db.query(Container).filter(Container.id.in_(ids)).update(
+                {'status': status}, synchronize_session=False)
+            for container in containers:
+                set_committed_value(container, 'status', status)
         
     def update_host_containers(self, db, host, config):
         """
         For a given host, update the application status and container
         state for all containers.
         """
-        wrapper = DockerWrapper(host.hostname, host.port, config)
-        host_container_info = []
+        host_container_info = self._fetch_host_state((host.hostname, host.port))
+        self._apply_host_state(db, host, host_container_info)
 
-        # Keep track of containers that go away
-        previous_host_containers = dict([(container.id, container) for container in host.containers])
-        new_host_containers = set()
-        
+    def _fetch_host_state(self, address):
+        """
+        Ask the docker daemon at (hostname, port) for the state of its
+        containers. Takes plain values rather than a Host so worker
+        threads never touch the session. Returns None when the host
+        could not be reached.
+        """
+        hostname, port = address
+        wrapper = self._wrapper_for(hostname, port)
         try:
-            host_container_info = wrapper.state_of_the_universe()
+            return wrapper.state_of_the_universe()
         except Exception as e:
             logging.error(e)
+            return None
+
+    def _fetch_hosts_state(self, hosts):
+        """
+        Run _fetch_host_state for several hosts concurrently and return
+        (host, info_list) pairs. Host attributes are read on the calling
+        thread; all session work stays with the caller.
+        """
+        if not hosts:
+            return []
+        addresses = [(host.hostname, host.port) for host in hosts]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return list(zip(hosts, executor.map(self._fetch_host_state, addresses)))
+
+    def _apply_host_state(self, db, host, host_container_info):
+        """
+        Write container state fetched by _fetch_host_state to the db
+        """
+        # Keep track of containers that go away
+        previous_host_containers = {container.id: container for container in host.containers}
+        new_host_containers = set()
+
+        if host_container_info is None:
+            host_container_info = []
             host.status = 'down'
             db.add(host)
         
+        # Look up images for all new containers at once
+        layers = {info['image_id'][0:8] for info in host_container_info
+                  if info['id'] not in previous_host_containers}
+        images = {}
+        if layers:
+            images = {image.id: image for image in db.query(Image).filter(Image.id.in_(layers)).all()}
+
+        rows = []
         for info in host_container_info:
-            container = Container.get(db, info['id'])
             new_host_containers.add(info['id'])
-            if container:
+            image_id = None
+            previous = previous_host_containers.get(info['id'])
+            if previous:
+                # Skip containers docker reports unchanged, so they never
+                # reach the upsert and are not reparsed. The stored value is
+                # checked as well in case the last write was rolled back;
+                # mysql drops sub-second precision, hence the tolerance.
+                raw_finished_at, finished_at = self._last_seen.get(info['id'], (None, None))
+                if (previous.state == info['state'] and raw_finished_at == info['finished_at']
+                        and previous.finished_at is not None
+                        and abs(previous.finished_at - finished_at) < timedelta(seconds=1)):
+                    continue
                 logging.info("Found existing container {}, updating state to: {}".format(info['id'], info['state']))
-                container.state = info['state']
-                container.finished_at = parser.parse(info['finished_at']).astimezone(tz.tzlocal()).replace(tzinfo=None)
-                db.add(container)
             else:
                 logging.info("Got new container {}, setting state to: {}".format(info['id'], info['state']))
-                image_layer = info['image_id'][0:8]
-                image = Image.get(db, image_layer)
-                container = Container(
-                    id=info['id'],
-                    image_ref=info['image_ref'],
-                    state = info['state'],
-                    started_at = parser.parse(info['started_at']).astimezone(tz.tzlocal()).replace(tzinfo=None),
-                    finished_at = parser.parse(info['finished_at']).astimezone(tz.tzlocal()).replace(tzinfo=None)
-                )
-                if 'command' in info:
-                    container.command = info['command']
+                image = images.get(info['image_id'][0:8])
                 if image:
-                    container.image = image
-                host.containers.append(container)
-                db.add(container)
-
-        for c_id in previous_host_containers:
-            if c_id not in new_host_containers:
-                logging.info("Previous container {} not found on host, removing".format(c_id))
-                container = previous_host_containers[c_id]
-                db.delete(container)
-                
+                    image_id = image.id
+            finished_at = _parse_docker_ts(info['finished_at'])
+            self._last_seen[info['id']] = (info['finished_at'], finished_at)
+            rows.append({
+                'id': info['id'],
+                'image_ref': info['image_ref'],
+                'state': info['state'],
+                'started_at': _parse_docker_ts(info['started_at']),
+                'finished_at': finished_at,
+                'command': info.get('command'),
+                'image_id': image_id,
+                'host_id': host.id
+            })
+
+        removed = set(previous_host_containers) - new_host_containers
+        for c_id in removed:
+            logging.info("Previous container {} not found on host, removing".format(c_id))
+
+        # Insert new containers and update state on existing ones in a
+        # single statement; only state and finished_at change on update
+        if rows:
+            stmt = insert(Container.__table__).values(rows)
+            stmt = stmt.on_duplicate_key_update(
+                state=stmt.inserted.state,
+                finished_at=stmt.inserted.finished_at)
+            db.execute(stmt)
+        if removed:
+            db.query(Container).filter(Container.id.in_(removed)).delete(synchronize_session=False)
+
+        # Objects are not expired on commit, so bring the loaded ones in
+        # line with what the upsert wrote without marking them dirty
+        for row in rows:
+            previous = previous_host_containers.get(row['id'])
+            if previous:
+                set_committed_value(previous, 'state', row['state'])
+                set_committed_value(previous, 'finished_at', row['finished_at'])
+        for c_id in removed:
+            self._last_seen.pop(c_id, None)
+        db.expire(host, ['containers'])
+
         db.add(host)
-        db.commit()
+        db.flush()
                         
     def update_all_containers(self, db, config):
         """
-        Updates every app and container state on all hosts
+        Updates every app and container state on all hosts. Applying
+        fetched state does no I/O, so those writes are batched.
         """
-        for host in db.query(Host).all():
+        counter = 0
+        hosts = db.query(Host).options(selectinload(Host.containers)).all()
+        # Don't hold the transaction open while waiting on docker
+        db.commit()
+
+        for host, host_container_info in self._fetch_hosts_state(hosts):
             logging.info("Updating containers for host: {}".format(host.hostname))
-            self.update_host_containers(db, host, config)
+            self._apply_host_state(db, host, host_container_info)
+            counter = self._batch_commit(db, counter)
+
+    def _batch_commit(self, db, counter, n=50):
+        """
+        Count one more unit of work, committing every n units.
+        Returns the new counter.
+        """
+        counter += 1
+        if counter % n == 0:
+            db.commit()
+        return counter
 
     def get_container_logs(self, container, config, stderr=True, stdout=False, limit=100):
-        wrapper = DockerWrapper(container.host.hostname, container.host.port, config)
+        wrapper = self._wrapper_for(container.host.hostname, container.host.port)
         return wrapper.logs(container.id, stdout=stdout, stderr=stderr, tail=limit)
+
+    def get_container_logs_stream(self, container, config, stderr=True, stdout=False, limit=100):
+        """
+        Like get_container_logs, but returns an iterator over log chunks
+        as docker sends them instead of one buffered blob
+        """
+        wrapper = self._wrapper_for(container.host.hostname, container.host.port)
+        return wrapper.logs(container.id, stdout=stdout, stderr=stderr, stream=True,
+                            tail=limit, follow=False)
         
     def update_all(self):
+        """
+        Refresh images, deployments and containers for everything we
+        know about. Each app step is committed when it succeeds, so row
+        locks are not held across registry, docker or status calls. A
+        failed step is rolled back and skipped; a database error rolls
+        back whatever is still pending and stops the refresh.
+        """
+        db = self._Session()
         try:
-            db = self.get_session(self.get_engine(self._config))
-        
-            apps = db.query(App).all()
+            apps = db.query(App).options(
+                selectinload(App.deployments).selectinload(Deployment.hosts),
+                selectinload(App.images).selectinload(Image.containers)
+            ).all()
             for app in apps:
                 logging.info("Updating image and deployment information for {}".format(app.name))
                 try:
                     self.update_app_images(db, app)
+                    db.commit()
+                except SQLAlchemyError:
+                    raise
                 except Exception as e:
                     logging.error(e)
                     db.rollback()
@@ -223,40 +416,50 @@ class Worker(object):
                 for deployment in app.deployments:
                     try:
                         self.update_deployment(db, deployment)
+                        db.commit()
+                    except SQLAlchemyError:
+                        raise
                     except Exception as e:
                         logging.error(e)
                         db.rollback()
                     
             logging.info("Updating container information")
-            try:
-                self.update_all_containers(db, self._config)
-            except Exception as e:
-                logging.error(e)
-                db.rollback()
+            self.update_all_containers(db, self._config)
+            db.commit()
         except Exception as e:
             logging.error(e)
-            pass
+            db.rollback()
+        finally:
+            self._Session.remove()
 
     def run_deployment(self, deployment_id):
-        thread = threading.Thread(target=self.launch_deployment, args=([deployment_id, self._config]))
-        thread.daemon = True
-        thread.start()
+        return self._executor.submit(self.launch_deployment, deployment_id, self._config)
         
     def launch_deployment(self, deployment_id, config):
-        db = self.get_session(self.get_engine(config))
-        
-        deployment = db.query(Deployment).get(deployment_id)
-        encoded = deployment.encode_with_deps(db)
-        logging.info("Launching deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
-        for host in deployment.hosts:
-            logging.info("Launching deployment {}:{}/{} on {}".format(deployment.app_name, deployment.image_tag, deployment.environment, host.alias))
-            wrapper = DockerWrapper(host.hostname, host.port, config)
-            wrapper.deploy_with_deps(encoded)
-
+        db = self._Session()
         try:
-            self.update_deployment_containers(db, deployment, config)
-            self.update_deployment_status(db, deployment)            
+            deployment = db.query(Deployment).get(deployment_id)
+            encoded = deployment.encode_with_deps(db)
+            logging.info("Launching deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
+            hosts = [(host.hostname, host.port, host.alias) for host in deployment.hosts]
+            # Nothing to write yet, end the read transaction before deploying
+            db.commit()
+            # Deploy is stop, rm, run, so hosts go one at a time to keep the
+            # app up elsewhere; the first failure stops the rollout
+            for hostname, port, alias in hosts:
+                logging.info("Launching deployment {}:{}/{} on {}".format(deployment.app_name, deployment.image_tag, deployment.environment, alias))
+                wrapper = self._wrapper_for(hostname, port)
+                wrapper.deploy_with_deps(encoded)
+
+            try:
+                self.update_deployment(db, deployment)
+                db.commit()
+            except Exception as e:
+                logging.error(e)
+                db.rollback()
+            logging.info("Finished deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
         except Exception as e:
-            logging.error(e)
-            db.rollback()
-        logging.info("Finished deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
+            # Nobody waits on the executor's future, so log here instead
+            logging.exception("Deployment {} failed".format(deployment_id))
+        finally:
+            self._Session.remove()
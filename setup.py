@@ -7,9 +7,9 @@ setup(name='click2care-mamabear',
       version=version,
       description='Manages docker containers',
       install_requires=[
-          'cherrypy', 'apscheduler', 'routes', 'sqlalchemy', 'mysql-python',
-          'docker-py', 'python-dateutil', 'pyopenssl', 'ndg-httpsclient',
-          'pyasn1'],
+          'cherrypy', 'apscheduler', 'routes', 'sqlalchemy>=1.2', 'mysql-python',
+          'docker-py>=1.8', 'python-dateutil', 'pyopenssl', 'ndg-httpsclient',
+          'pyasn1', 'futures>=3.2'],
       packages=find_packages(),
       py_modules=['mamabear',],
       include_package_data=True,